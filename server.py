@@ -7,14 +7,21 @@ Usage:
     python server.py
 """
 
+import asyncio
 import hashlib
-import io
+import json
+import logging
 import os
+import tempfile
+from collections.abc import AsyncIterator
+from functools import lru_cache
 from pathlib import Path
 
 import edge_tts
 from aiohttp import web
 
+logger = logging.getLogger(__name__)
+
 # === Configuration ===
 CACHE_DIR = Path("cache/tts")
 CACHE_DIR.mkdir(parents=True, exist_ok=True)
@@ -31,10 +38,114 @@ VOICES = {
 DEFAULT_VOICE = "yunxi"
 DEFAULT_RATE = "-10%"
 
+AUDIO_HEADERS = {
+    "Content-Type": "audio/mpeg",
+    "Access-Control-Allow-Origin": "*",
+    "Cache-Control": "public, max-age=86400",
+}
+
+# The voice list never changes at runtime, so serialize it once
+VOICES_JSON = json.dumps([{"key": k, "name": v} for k, v in VOICES.items()]).encode()
+
+
+class SynthesisError(Exception):
+    """A shared synthesis failed; raised separately to each requester."""
+
+
+class Synthesis:
+    """Audio for one cache key, generated once and relayed to every requester."""
+
+    def __init__(self) -> None:
+        self.chunks: list[bytes] = []
+        self.finished = False
+        self.error: Exception | None = None
+        # Strong reference so the background task isn't garbage-collected
+        self.task: asyncio.Task | None = None
+        self._changed = asyncio.Event()
+
+    def _notify(self) -> None:
+        # Wake current waiters; later ones wait on a fresh event
+        self._changed.set()
+        self._changed = asyncio.Event()
 
+    def add(self, data: bytes) -> None:
+        self.chunks.append(data)
+        self._notify()
+
+    def finish(self, error: Exception | None = None) -> None:
+        self.finished = True
+        self.error = error
+        self._notify()
+
+    async def stream(self) -> AsyncIterator[bytes]:
+        """Yield audio chunks as they arrive, raising if synthesis failed."""
+        sent = 0
+        while True:
+            while sent < len(self.chunks):
+                yield self.chunks[sent]
+                sent += 1
+            if self.finished:
+                if self.error is not None:
+                    # A fresh exception per requester, so tracebacks from
+                    # different handlers don't pile up on the shared error
+                    raise SynthesisError(str(self.error)) from self.error
+                return
+            await self._changed.wait()
+
+
+# Syntheses currently running, by cache key, so identical requests share one
+_inflight: dict[str, Synthesis] = {}
+
+
+@lru_cache(maxsize=4096)
 def tts_cache_key(text: str, voice: str, rate: str) -> str:
-    h = hashlib.sha256(f"{text}|{voice}|{rate}".encode()).hexdigest()[:16]
-    return h
+    return hashlib.blake2b(f"{text}|{voice}|{rate}".encode(), digest_size=8).hexdigest()
+
+
+def write_cache_file(path: Path, data: bytes) -> None:
+    """Write data via a temp file and rename, so readers never see a partial file."""
+    path.parent.mkdir(exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+async def synthesize(
+    text: str, voice: str, rate: str, key: str, cached_path: Path, synthesis: Synthesis
+) -> None:
+    """Run one edge-tts synthesis to completion and cache the result.
+
+    Runs in its own task so that no single client's connection decides
+    whether the audio is finished and cached.
+    """
+    try:
+        communicate = edge_tts.Communicate(text, voice, rate=rate)
+        async for chunk in communicate.stream():
+            if chunk["type"] == "audio":
+                synthesis.add(chunk["data"])
+        if not synthesis.chunks:
+            raise RuntimeError("No audio generated")
+    except Exception as e:
+        synthesis.finish(e)
+    else:
+        synthesis.finish()
+        try:
+            await asyncio.to_thread(write_cache_file, cached_path, b"".join(synthesis.chunks))
+        except OSError:
+            # Requesters already have the audio; a failed cache write only
+            # means the next request synthesizes it again
+            logger.exception("Failed to write TTS cache file %s", cached_path)
+    finally:
+        if not synthesis.finished:
+            synthesis.finish(RuntimeError("Synthesis was interrupted"))
+        # Only drop the entry once the cache file exists, so later requests
+        # find either the file or the finished synthesis
+        _inflight.pop(key, None)
 
 
 async def handle_tts(request: web.Request) -> web.StreamResponse:
@@ -48,47 +159,47 @@ async def handle_tts(request: web.Request) -> web.StreamResponse:
 
     voice = VOICES.get(voice_key, VOICES[DEFAULT_VOICE])
     key = tts_cache_key(text, voice, rate)
-    cached_path = CACHE_DIR / f"{key}.mp3"
+    # Shard by key prefix so no single directory grows unbounded
+    cached_path = CACHE_DIR / key[:2] / f"{key}.mp3"
 
     if cached_path.exists():
-        return web.FileResponse(
-            cached_path,
-            headers={
-                "Content-Type": "audio/mpeg",
-                "Access-Control-Allow-Origin": "*",
-                "Cache-Control": "public, max-age=86400",
-            },
+        return web.FileResponse(cached_path, headers=AUDIO_HEADERS)
+
+    synthesis = _inflight.get(key)
+    if synthesis is None:
+        synthesis = _inflight[key] = Synthesis()
+        synthesis.task = asyncio.create_task(
+            synthesize(text, voice, rate, key, cached_path, synthesis)
         )
 
+    response = None
     try:
-        communicate = edge_tts.Communicate(text, voice, rate=rate)
-        audio_data = io.BytesIO()
-        async for chunk in communicate.stream():
-            if chunk["type"] == "audio":
-                audio_data.write(chunk["data"])
-
-        audio_bytes = audio_data.getvalue()
-        if not audio_bytes:
-            return web.json_response({"error": "No audio generated"}, status=500)
-
-        cached_path.write_bytes(audio_bytes)
-
-        return web.Response(
-            body=audio_bytes,
-            content_type="audio/mpeg",
-            headers={
-                "Access-Control-Allow-Origin": "*",
-                "Cache-Control": "public, max-age=86400",
-            },
-        )
-    except Exception as e:
+        async for data in synthesis.stream():
+            # Start the response on the first chunk so errors before any
+            # audio can still be reported as JSON
+            if response is None:
+                response = web.StreamResponse(headers=AUDIO_HEADERS)
+                await response.prepare(request)
+            await response.write(data)
+        await response.write_eof()
+    except SynthesisError as e:
+        if response is not None:
+            # Headers are already sent; let aiohttp drop the connection
+            raise
         return web.json_response({"error": str(e)}, status=500)
+    except ConnectionError:
+        # The client went away; the synthesis carries on without it
+        return response
+    return response
 
 
 async def handle_voices(request: web.Request) -> web.Response:
     """Return available voices."""
-    voice_list = [{"key": k, "name": v} for k, v in VOICES.items()]
-    return web.json_response(voice_list, headers={"Access-Control-Allow-Origin": "*"})
+    return web.Response(
+        body=VOICES_JSON,
+        content_type="application/json",
+        headers={"Access-Control-Allow-Origin": "*"},
+    )
 
 
 async def handle_options(request: web.Request) -> web.Response: